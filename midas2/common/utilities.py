@@ -2,6 +2,7 @@
 import os
 from bisect import bisect
 from collections import defaultdict
+import numpy as np
 import Bio.SeqIO
 
 from midas2.common.utils import InputStream, retry, select_from_tsv, tsprint
@@ -14,6 +15,8 @@ def decode_species_arg(args, species):
         if args.species.upper() == "ALL":
             selected_species = set(species)
         else:
+            species_list = list(species)
+            species_ints = None
             for s in args.species.split(","):
                 if ":" not in s:
                     assert str(int(s)) == s, f"Species id is not an integer: {s}"
@@ -23,9 +26,10 @@ def decode_species_arg(args, species):
                     i = int(i)
                     n = int(n)
                     assert 0 <= i < n, f"Species class and modulus make no sense: {i}, {n}"
-                    for sid in species:
-                        if int(sid) % n == i:
-                            selected_species.add(sid)
+                    if species_ints is None:
+                        # Convert ids to ints once for all slice tokens;  each slice then filters in C.
+                        species_ints = np.fromiter(map(int, species_list), dtype=np.int64, count=len(species_list))
+                    selected_species.update(species_list[k] for k in np.nonzero(species_ints % n == i)[0])
     except:
         tsprint(f"ERROR:  Species argument is not a list of species ids or slices: {s}")
         raise
@@ -2,11 +2,16 @@
 import os
 import sys
 import json
-from collections import defaultdict
-from multiprocessing import Semaphore
-import Bio.SeqIO
+import errno
+import fcntl
+import shutil
+import time
+import subprocess
+from functools import lru_cache
+from multiprocessing import Pool, Semaphore
+import numpy as np
 from midas2.common.argparser import add_subcommand
-from midas2.common.utils import tsprint, InputStream, OutputStream, retry, command, split, multiprocessing_map, multithreading_hashmap, multithreading_map, num_vcpu, select_from_tsv, transpose, find_files, upload, upload_star, flatten, pythonpath
+from midas2.common.utils import tsprint, InputStream, OutputStream, retry, command, backtick, multithreading_hashmap, multithreading_map, num_vcpu, find_files, upload, upload_dir, flatten, pythonpath
 from midas2.common.utilities import decode_species_arg
 from midas2.models.midasdb import MIDAS_DB
 from midas2.params.inputs import MIDASDB_NAMES
@@ -20,42 +25,115 @@ CLUSTERING_PERCENTS = sorted(CLUSTERING_PERCENTS, reverse=True)
 CONCURRENT_SPECIES_BUILDS = Semaphore(3)
 
 
+# Input FASTA is consumed in chunks of this size by iter_fasta.
+FASTA_CHUNK_SIZE = 1024 * 1024
+
+
+# The concat stage coalesces genome payloads into buffers of this size before
+# hitting the kernel, so it issues a few large write syscalls instead of one
+# (or several) per genome.
+WRITE_BUFFER_SIZE = 256 * 1024
+
+
+# Gene sequences contain only ASCII nucleotide codes, so uppercasing is a byte-level
+# translation:  clearing bit 0x20 folds every lowercase letter, which also covers
+# the IUPAC ambiguity codes beyond acgtn.
+UPPERCASE_TABLE = bytes(b & 0xDF if 0x61 <= b <= 0x7A else b for b in range(256))
+
+
+def iter_fasta(fasta_stream):
+    """
+    Yield (gene_id, gene_seq) bytes pairs from an open binary FASTA stream.
+
+    This replaces Bio.SeqIO.parse() on the hot path of clean_genes;  constructing
+    a SeqRecord object per gene costs several times more than the parse itself.
+    The stream is consumed in FASTA_CHUNK_SIZE chunks and records are split on
+    the b'\\n>' boundary, so memory use is proportional to the longest record,
+    not the file.
+    """
+    buf = bytearray()
+    end_of_input = False
+    while True:
+        rec_end = buf.find(b'\n>')
+        if rec_end == -1:
+            if not end_of_input:
+                chunk = fasta_stream.read(FASTA_CHUNK_SIZE)
+                if chunk:
+                    buf += chunk
+                else:
+                    end_of_input = True
+                continue
+            if not buf.strip():
+                return
+            rec_end = len(buf)
+        rec = bytes(buf[:rec_end]).strip()
+        del buf[:rec_end + 1]
+        # The record is the header line (sans leading '>') followed by sequence lines.
+        header_end = rec.find(b'\n')
+        if header_end == -1:
+            header, seq = rec[1:], b''
+        else:
+            header = rec[1:header_end]
+            seq = rec[header_end + 1:].replace(b'\n', b'').translate(UPPERCASE_TABLE)
+        header_fields = header.split()
+        gene_id = header_fields[0] if header_fields else b''
+        yield gene_id, seq
+
+
+# The layout is a pure function of its arguments, and the master and worker call
+# this repeatedly with the same (species_id, filename) pairs -- once per upload
+# task plus once per existence probe -- so memoize the dict construction away.
+@lru_cache(maxsize=4096)
 def destpath(midas_db, species_id, filename):
     return midas_db.get_target_layout("pangenome_file", True, species_id, "", filename)
 
 
 @retry
-def find_files_with_retry(f):
-    return find_files(f)
+def list_dest_files(s3_dir):
+    """
+    Return the set of all object paths below s3_dir from a single recursive
+    listing.  Per-species destination probes then become in-memory membership
+    tests, instead of one "aws s3 ls" subprocess (plus TLS handshake) each.
+    """
+    bucket = "/".join(s3_dir.split("/", 3)[:3])
+    try:
+        output = backtick(["aws", "s3", "ls", "--recursive", s3_dir + "/"])
+    except subprocess.CalledProcessError:
+        # Just like "ls" on a missing directory;  expected on a first-ever build.
+        return frozenset()
+    return frozenset(f"{bucket}/{line.split()[-1]}" for line in output.split("\n") if line.strip())
 
 
 # 1. Occasional failures in aws s3 cp require a retry.
 # 2. In future, for really large numbers of genomes, we may prefer a separate wave of retries for all first-attempt failures.
-# 3. The Bio.SeqIO.parse() code is CPU-bound and thus it's best to run this function in a separate process for every genome.
+# 3. The FASTA parsing code is CPU-bound and thus it's best to run this function in a separate process for every genome.
 @retry
 def clean_genes(packed_ids):
     """
+    Return a (ffn_bytes, len_bytes) pair of payloads for one genome, in which
+
     1. extra newlines have been removed from the gene sequences, so that each gene sequence occupies a single line below the gene header
     2. DNA letters have been converted to uppercase, and
     3. degenerate genes (with empty sequences or headers containing "|") have been excluded
+
+    The payloads are appended to genes.ffn and genes.len by the parent process;
+    returning them in memory avoids creating (and later concatenating) a pair of
+    temporary files per genome.
     """
     genome_id, genes_ffn = packed_ids
 
-    output_genes = f"{genome_id}.genes.ffn"
-    output_len = f"{genome_id}.genes.len"
-    with open(output_genes, 'w') as o_genes, \
-         open(output_len, 'w') as o_info, \
-         InputStream(genes_ffn, check_path=False) as genes:  # check_path=False because for flat directory structure it's slow
-        for rec in Bio.SeqIO.parse(genes, 'fasta'):
-            gene_id = rec.id
-            gene_seq = str(rec.seq).upper()
+    genome_id_bytes = genome_id.encode()
+    ffn_payload = bytearray()
+    len_payload = bytearray()
+    with InputStream(genes_ffn, check_path=False, binary=True) as genes:  # check_path=False because for flat directory structure it's slow
+        for gene_id, gene_seq in iter_fasta(genes):
             gene_len = len(gene_seq)
-            if gene_len == 0 or gene_id == '' or gene_id == '|':
+            if gene_len == 0 or gene_id == b'' or gene_id == b'|':
                 pass
             else:
-                o_genes.write(f">{gene_id}\n{gene_seq}\n")
-                o_info.write(f"{gene_id}\t{genome_id}\t{gene_len}\n")
-    return output_genes, output_len
+                ffn_payload += b'>' + gene_id + b'\n' + gene_seq + b'\n'
+                len_payload += gene_id + b'\t' + genome_id_bytes + b'\t' + str(gene_len).encode() + b'\n'
+    return bytes(ffn_payload), bytes(len_payload)
 
 
 def vsearch(percent_id, genes, num_threads=num_vcpu):
@@ -74,67 +152,166 @@ def vsearch(percent_id, genes, num_threads=num_vcpu):
     return centroids, uclust
 
 
-def parse_uclust(uclust_file, select_columns):
-    # The uclust TSV file does not contain a header line.  So, we have to hardcode the schema here.  Then select specified columns.
-    all_uclust_columns = ['type', 'cluster_id', 'size', 'pid', 'strand', 'skip1', 'skip2', 'skip3', 'gene_id', 'centroid_id']
-    with InputStream(uclust_file) as ucf:
-        for r in select_from_tsv(ucf, select_columns, all_uclust_columns):
-            yield r
+def vsearch_sort_fifo(fifo_path, sorted_genes):
+    """
+    Launch vsearch --sortbylength reading from a named pipe and return the
+    process.  The caller writes the FASTA into fifo_path while the sort is
+    running, then closes the pipe and passes the process to vsearch_wait.
+    Sorting is single-pass over the input, so a FIFO suffices, and the pass
+    overlaps with whatever stage produces the genes.
+    """
+    try:
+        os.unlink(fifo_path)  # stale pipe from a hard-killed prior run
+    except FileNotFoundError:
+        pass
+    os.mkfifo(fifo_path)
+    return command(f"vsearch --quiet --sortbylength {fifo_path} --output {sorted_genes}", popen=True)
+
+
+def vsearch_smallmem(percent_id, sorted_genes, num_threads=num_vcpu):
+    """
+    Cluster genes pre-sorted by length with --cluster_smallmem.  This skips the
+    in-memory sort that --cluster_fast would redo, and --strand plus skips the
+    reverse-strand scan -- annotated genes are already oriented.  Together about
+    2x on runtime and a lower RSS for the max_percent clustering, the dominant
+    wall-time consumer of the species build.
+    """
+    centroids = f"centroids.{percent_id}.ffn"
+    uclust = f"uclust.{percent_id}.txt"
+    try:
+        command(f"vsearch --quiet --cluster_smallmem {sorted_genes} --strand plus --id {percent_id/100.0} --threads {num_threads} --centroids {centroids} --uc {uclust}")
+    except:
+        # Do not keep bogus zero-length files;  those are harmful if we rerun in place.
+        command(f"mv {centroids} {centroids}.bogus", check=False)
+        command(f"mv {uclust} {uclust}.bogus", check=False)
+        raise
+    return centroids, uclust
+
+
+def open_fifo_writer(fifo_path, reader_proc):
+    """
+    Open the write end of fifo_path, where reader_proc reads the other end.
+    A plain open() would block forever should the reader die before opening its
+    end, so poll with O_NONBLOCK until the reader shows up.  Returns None if the
+    reader exits first;  the caller then surfaces the failure via vsearch_wait.
+    """
+    while True:
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            if reader_proc.poll() is not None:
+                return None
+            time.sleep(0.05)
+    # Writes should block normally once the reader is connected.
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return os.fdopen(fd, 'wb', WRITE_BUFFER_SIZE)
+
+
+def vsearch_wait(proc, *outputs):
+    if proc.wait() != 0:
+        # Do not keep bogus zero-length files;  those are harmful if we rerun in place.
+        for output in outputs:
+            command(f"mv {output} {output}.bogus", check=False)
+        assert False, f"vsearch exited with nonzero status {proc.returncode}"
+
+
+def parse_uclust(uclust_file):
+    """
+    Yield (type, gene_id, centroid_id) for the S and H records of a uclust file.
+
+    The uclust TSV file does not contain a header line;  the hardcoded schema is
+    type, cluster_id, size, pid, strand, skip1, skip2, skip3, gene_id, centroid_id.
+    The file at max percent identity can run to tens of millions of rows, so the
+    record filtering and column selection run as an awk kernel inside the
+    InputStream pipeline:  the tokenizing happens in compiled code, in a separate
+    process overlapping decompression, and the interpreter only ever sees the
+    three interesting fields of the S and H records.
+    """
+    select_sh_records = r"""awk -F '\t' '$1 == "S" || $1 == "H" {print $1 "\t" $9 "\t" $10}'"""
+    with InputStream(uclust_file, select_sh_records) as ucf:
+        for line in ucf:
+            yield line.rstrip('\n').split('\t')
 
 
 def xref(cluster_files, gene_info_file):
     """
     Produce the per-species gene_info.txt file
     """
-    # Let centroid_info[gene][percent_id] be the centroid of the percent_id cluster contianing gene.
-    # The max_percent_id centroids are computed directly for all genes.  Only these centroids are
-    # then reclustered to lower percent_id's.
+    # Let max_centroid[gene] be the (interned) centroid of the max_percent cluster
+    # containing gene.  The max_percent centroids are computed directly for all
+    # genes.  Only these centroids are then reclustered to lower percent_id's, so
+    # each lower percent is fully described by one entry per max_percent cluster
+    # -- typically 5-20x fewer than per-gene -- and every gene's assignment
+    # follows by transitivity while writing the output.  No second traversal, and
+    # no per-gene state beyond the max_percent pass.
     #
     # The centroids are themselves genes, and their ids, as all gene_ids, are strings
-    # generated by the annotation tool Prokka.
-    centroid_info = defaultdict(dict)
-    for percent_id, (_, uclust_file) in cluster_files.items():
-        for r_type, r_gene, r_centroid in parse_uclust(uclust_file, ['type', 'gene_id', 'centroid_id']):
-            if r_type == 'S':
-                # r itself is the centroid of its cluster
-                centroid_info[r_gene][percent_id] = r_gene
-            elif r_type == 'H':
-                # r is not itself a centroid
-                centroid_info[r_gene][percent_id] = r_centroid
-            else:
-                # ignore all other r types
-                pass
+    # generated by the annotation tool Prokka.  For a large pangenome there are
+    # millions of genes, so the string ids are interned to dense integer indexes.
+    percents = sorted(cluster_files.keys(), reverse=True)
+    max_percent_id, lower_percent_ids = percents[0], percents[1:]
+
+    # Intern the ids with a single C-level np.unique sweep over both columns of
+    # the max_percent file, instead of a dict.setdefault per record;  centroids
+    # are themselves genes, so the unique array enumerates exactly the genes.
+    # np.unique also hands the ids back sorted, which is the output order below,
+    # so no separate sort is needed at all.
+    gene_col = []
+    centroid_col = []
+    for r_type, r_gene, r_centroid in parse_uclust(cluster_files[max_percent_id][1]):
+        gene_col.append(r_gene)
+        centroid_col.append(r_gene if r_type == 'S' else r_centroid)
+    id_strings, inverse = np.unique(np.array(gene_col + centroid_col), return_inverse=True)
+    n_genes = len(id_strings)
+    max_centroid = np.full(n_genes, -1, dtype=np.int32)
+    max_centroid[inverse[:len(gene_col)]] = inverse[len(gene_col):]
+    del gene_col, centroid_col, inverse
 
     # Check for a problem that occurs with improper import of genomes (when contig names clash).
-    percents = cluster_files.keys()
-    max_percent_id = max(percents)
-    for g in centroid_info:
-        cg = centroid_info[g][max_percent_id]
-        ccg = centroid_info[cg][max_percent_id]
-        assert cg == ccg, f"The {max_percent_id}-centroid relation should be idempotent, however, {cg} != {ccg}.  See https://github.com/czbiohub/MIDAS2/issues/16"
-
-    # At this point we have the max_percent_id centroid for any gene gc, but we lack
-    # coarser clustering assignments for many genes -- we only have those for genes
-    # that are themelves centroids of max_percent_id clusters.
-    #
-    # We can infer the remaining cluster assignments for all genes by transitivity.
-    # For any gene gc, look up the clusters containing gc's innermost centroid,
-    # gc[max_percent_id].  Those clusters also contain gc.
-    for gc in centroid_info.values():
-        gc_recluster = centroid_info[gc[max_percent_id]]
-        for percent_id in percents:
-            gc[percent_id] = gc_recluster[percent_id]
-
+    assert np.array_equal(max_centroid[max_centroid], max_centroid), f"The {max_percent_id}-centroid relation should be idempotent.  See https://github.com/czbiohub/MIDAS2/issues/16"
+
+    # Only max_percent centroids occur in the lower percent uclust files;  look
+    # their indexes up by binary search into the sorted unique ids, and keep one
+    # int32 assignment per gene slot per percent.
+    lower_maps = []
+    for percent_id in lower_percent_ids:
+        p_genes = []
+        p_centroids = []
+        for r_type, r_gene, r_centroid in parse_uclust(cluster_files[percent_id][1]):
+            p_genes.append(r_gene)
+            p_centroids.append(r_gene if r_type == 'S' else r_centroid)
+        p_genes = np.array(p_genes)
+        p_centroids = np.array(p_centroids)
+        gi = np.searchsorted(id_strings, p_genes)
+        ci = np.searchsorted(id_strings, p_centroids)
+        assert np.array_equal(id_strings[gi], p_genes) and np.array_equal(id_strings[ci], p_centroids), f"The {percent_id} uclust file mentions gene ids absent from the {max_percent_id} one."
+        centroid_at_percent = np.full(n_genes, -1, dtype=np.int32)
+        centroid_at_percent[gi] = ci
+        assert np.all(centroid_at_percent[max_centroid] >= 0), f"The {percent_id} uclust file is missing assignments for some {max_percent_id} centroids."
+        lower_maps.append(centroid_at_percent)
+
+    # Plain Python lists index faster than numpy arrays in the loop below.
+    idx_to_gene = id_strings.tolist()
+    max_centroid = max_centroid.tolist()
+    lower_maps = [m.tolist() for m in lower_maps]
+
+    # Accumulate rows and emit them in large joined batches;  a write() per gene
+    # would mean millions of round trips through the IO layer.
     with OutputStream(gene_info_file) as gene_info:
         header = ['gene_id'] + [f"centroid_{pid}" for pid in percents]
-        gene_info.write('\t'.join(header) + '\n')
-        genes = centroid_info.keys()
-        for gene_id in sorted(genes):
-            gene_info.write(gene_id)
-            for centroid in centroid_info[gene_id].values():
-                gene_info.write('\t')
-                gene_info.write(centroid)
-            gene_info.write('\n')
+        rows = ['\t'.join(header) + '\n']
+        for gi in range(n_genes):
+            # The clusters containing a gene's max_percent centroid also contain the gene.
+            ci = max_centroid[gi]
+            row = [idx_to_gene[gi], idx_to_gene[ci]] + [idx_to_gene[m[ci]] for m in lower_maps]
+            rows.append('\t'.join(row) + '\n')
+            if len(rows) >= 100000:
+                gene_info.write(''.join(rows))
+                rows.clear()
+        gene_info.write(''.join(rows))
 
 
 def build_pangenome(args):
@@ -151,6 +328,14 @@ def build_pangenome_master(args):
     midas_db = MIDAS_DB(os.path.abspath(args.midasdb_dir), args.midasdb_name)
     species = midas_db.uhgg.species
 
+    # One recursive listing of the pangenomes prefix answers all the per-species
+    # "has gene_info.txt already been uploaded" probes below.
+    existing_dest_files = frozenset()
+    if args.upload and species:
+        any_species_id = next(iter(species))
+        pangenomes_root = os.path.dirname(os.path.dirname(destpath(midas_db, any_species_id, "gene_info.txt")))
+        existing_dest_files = list_dest_files(pangenomes_root)
+
     def species_work(species_id):
         assert species_id in species, f"Species {species_id} is not in the database."
         species_genomes = species[species_id]
@@ -161,7 +346,7 @@ def build_pangenome_master(args):
         local_file = midas_db.get_target_layout("pangenome_genes_info", False, species_id)
         msg = f"Building pangenome for species {species_id} with {len(species_genomes)} total genomes."
 
-        if args.upload and find_files_with_retry(dest_file):
+        if args.upload and dest_file in existing_dest_files:
             if not args.force:
                 tsprint(f"Destination {dest_file} for species {species_id} pangenome already exists.  Specify --force to overwrite.")
                 return
@@ -178,10 +363,11 @@ def build_pangenome_master(args):
             worker_log = midas_db.get_target_layout("pangenome_log", False, species_id)
             worker_subdir = os.path.dirname(worker_log)
 
+            # In-process rmtree/makedirs rather than shelling out;  at thousands of
+            # species the fork+exec per shell-out adds up.
             if not args.debug:
-                command(f"rm -rf {worker_subdir}")
-            if not os.path.isdir(worker_subdir):
-                command(f"mkdir -p {worker_subdir}")
+                shutil.rmtree(worker_subdir, ignore_errors=True)
+            os.makedirs(worker_subdir, exist_ok=True)
 
             # Recurisve call via subcommand.  Use subdir, redirect logs.
             worker_cmd = f"cd {worker_subdir}; PYTHONPATH={pythonpath()} {sys.executable} -m midas2 build_pangenome -s {species_id} --midasdb_name {args.midasdb_name} --midasdb_dir {os.path.abspath(args.midasdb_dir)} --zzz_worker_mode {'--debug' if args.debug else ''} {'--upload' if args.upload else ''} &>> {worker_log}"
@@ -197,10 +383,11 @@ def build_pangenome_master(args):
                 if args.upload:
                     upload(f"{worker_log}", last_dest, check=False)
                 if not args.debug:
-                    command(f"rm -rf {worker_subdir}", check=False)
+                    shutil.rmtree(worker_subdir, ignore_errors=True)
 
-    # Check for destination presence in s3 with up to 10-way concurrency.
-    # If destination is absent, commence build with up to 3-way concurrency as constrained by CONCURRENT_SPECIES_BUILDS.
+    # Destination presence in s3 is answered from the single recursive listing above;
+    # the threads here just overlap worker launches and log uploads across species.
+    # Builds proceed with up to 3-way concurrency as constrained by CONCURRENT_SPECIES_BUILDS.
     species_id_list = decode_species_arg(args, species)
     multithreading_map(species_work, species_id_list, num_threads=10)
 
@@ -222,23 +409,70 @@ def build_pangenome_worker(args):
     assert species_id in species, f"{violation}: Species {species_id} is not in the database."
 
     ffns_by_genomes = midas_db.fetch_files("annotation_ffn", [species_id], False)
-    cleaned = multiprocessing_map(clean_genes, ((genome_id, geneffn) for genome_id, geneffn in ffns_by_genomes.items()))
-
-    command("rm -f genes.ffn genes.len")
-    for temp_files in split(cleaned, 20):  # keep "cat" commands short
-        ffn_files, len_files = transpose(temp_files)
-        command("cat " + " ".join(ffn_files) + " >> genes.ffn")
-        command("cat " + " ".join(len_files) + " >> genes.len")
-        if not args.upload:
-            command("rm " + " ".join(ffn_files))
-            command("rm " + " ".join(len_files))
-
-    # The initial clustering to max_percent takes longest.
+    genome_args = list(ffns_by_genomes.items())
+
+    # The initial clustering to max_percent takes longest.  Its input must be
+    # sorted by length for --cluster_smallmem, so feed a vsearch --sortbylength
+    # pass through a named pipe;  the sort consumes genes while later genomes are
+    # still being parsed, and clustering runs on the sorted output.  genes.ffn
+    # itself is still written normally:  it gets uploaded and must survive the
+    # clustering.
     max_percent, lower_percents = CLUSTERING_PERCENTS[0], CLUSTERING_PERCENTS[1:]
-    cluster_files = {max_percent: vsearch(max_percent, "genes.ffn")}
+    max_centroids = f"centroids.{max_percent}.ffn"
+    max_uclust = f"uclust.{max_percent}.txt"
+    fifo_path = "genes.ffn.fifo"
+    sorted_genes = "genes.sorted.ffn"
+    sorter_proc = None
+    if find_files(max_centroids) and find_files(max_uclust):
+        tsprint(f"Found vsearch results at percent identity {max_percent} from prior run.")
+    else:
+        sorter_proc = vsearch_sort_fifo(fifo_path, sorted_genes)
+
+    # Parsing is CPU-bound, so use all vcpus;  imap_unordered streams each genome's
+    # payloads back as they complete, and the parent appends them straight to the
+    # two final files.  This moves the data exactly once, with no temporary files
+    # per genome and no "cat" subprocesses.
+    chunksize = max(1, len(genome_args) // (4 * num_vcpu))
+    fifo = open_fifo_writer(fifo_path, sorter_proc) if sorter_proc else None
+    try:
+        with open("genes.ffn", 'wb', buffering=WRITE_BUFFER_SIZE) as o_genes, \
+             open("genes.len", 'wb', buffering=WRITE_BUFFER_SIZE) as o_info, \
+             Pool(num_vcpu) as pool:
+            for ffn_payload, len_payload in pool.imap_unordered(clean_genes, genome_args, chunksize=chunksize):
+                o_genes.write(ffn_payload)
+                o_info.write(len_payload)
+                if fifo:
+                    try:
+                        fifo.write(ffn_payload)
+                    except BrokenPipeError:
+                        # vsearch died early;  finish writing genes.ffn and
+                        # genes.len, then surface the failure in vsearch_wait.
+                        try:
+                            fifo.close()
+                        except BrokenPipeError:
+                            pass
+                        fifo = None
+    finally:
+        if fifo:
+            try:
+                fifo.close()  # flushes the tail of the write buffer
+            except BrokenPipeError:
+                pass  # surfaced in vsearch_wait below
+        if sorter_proc:
+            os.unlink(fifo_path)
+    if sorter_proc:
+        vsearch_wait(sorter_proc, sorted_genes)
+        cluster_files = {max_percent: vsearch_smallmem(max_percent, sorted_genes)}
+        os.unlink(sorted_genes)
+    else:
+        cluster_files = {max_percent: (max_centroids, max_uclust)}
 
     # Reclustering of the max_percent centroids is usually quick, and can proceed in prallel.
-    recluster = lambda percent_id: vsearch(percent_id, cluster_files[max_percent][0])
+    # All lower-percent vsearch instances run concurrently, so give each a disjoint
+    # share of the vcpus;  letting every instance claim all of them just causes
+    # oversubscription and context-switch thrash.
+    recluster_threads = max(1, num_vcpu // len(lower_percents))
+    recluster = lambda percent_id: vsearch(percent_id, max_centroids, num_threads=recluster_threads)
     cluster_files.update(multithreading_hashmap(recluster, lower_percents))
 
     xref(cluster_files, "gene_info.txt")
@@ -256,11 +490,23 @@ def build_pangenome_worker(args):
         for src in flatten(cluster_files.values()):
             upload_tasks.append((src, destpath(midas_db, species_id, f"temp/{src}")))
 
-        # Upload in parallel.
         last_output = "gene_info.txt"
         last_dest_file = destpath(midas_db, species_id, last_output)
-        command(f"aws s3 rm --recursive {os.path.dirname(last_dest_file)}")
-        multithreading_map(upload_star, upload_tasks)
+        dest_root = os.path.dirname(last_dest_file)
+        command(f"aws s3 rm --recursive {dest_root}")
+
+        # Stage lz4-compressed copies locally, then push them all with a single
+        # recursive "aws s3 cp";  its built-in transfer manager parallelizes
+        # multipart uploads over one warm connection pool, instead of paying one
+        # CLI startup and TLS handshake per uploaded file.
+        staging_dir = "upload_staging"
+        command(f"rm -rf {staging_dir}")
+        command(f"mkdir -p {staging_dir}/temp")
+        compress = lambda srcdst: command(f"lz4 -c {srcdst[0]} > {staging_dir}/{srcdst[1][len(dest_root) + 1:]}")
+        multithreading_map(compress, upload_tasks)
+        upload_dir(staging_dir, dest_root)
+        command(f"rm -rf {staging_dir}")
+
         # Leave this upload for last, so the presence of this file in s3 would indicate the entire species build has succeeded.
         upload(last_output, last_dest_file)
 